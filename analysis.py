@@ -1,8 +1,15 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+from numba import njit, prange
 import warnings
 import sys
 import matplotlib.pyplot as plt
 import os
+import glob
+import hashlib
 
 # Suppress warnings for cleaner output
 warnings.filterwarnings('ignore', category=FutureWarning)
@@ -12,6 +19,7 @@ warnings.filterwarnings('ignore', category=UserWarning)
 GNAF_FILE = "gnaf_prop.parquet"
 TRANSACTIONS_FILE = "transactions.parquet"
 RESULTS_DIR = "Results"
+CACHE_DIR = ".cache"
 
 GNAF_PROP_ID_COL = 'gnaf_pid'
 GNAF_MESH_BLOCK_COL = 'mb_2016_code'
@@ -19,32 +27,45 @@ GNAF_MESH_BLOCK_COL = 'mb_2016_code'
 TRANS_PROP_ID_COL = 'gnaf_pid'
 TRANS_PRICE_COL = 'price'
 TRANS_DATE_COL = 'date_sold'
+TRANS_DATE_FORMAT = '%Y-%m-%d'
 
 LAST_N_YEARS_FOR_GROWTH = 5
 MINIMUM_SALES_COUNT = 3
+MINIMUM_SALE_PRICE = 10000
+
+# Stream by sale year only if that reads each row group at most this many times on average
+MAX_STREAMING_READS_PER_ROW_GROUP = 3
+
+# Property IDs stay in contiguous Arrow string buffers rather than Python str objects
+ARROW_STRING_DTYPE = pd.ArrowDtype(pa.string())
 
 
 def decode_binary_column(df, col_name):
-    """Decode a binary Parquet column to Python strings."""
+    """Cast an Arrow-backed binary or string column to stripped Arrow strings in one vectorized pass."""
     if col_name not in df.columns:
         return df
-    df[col_name] = df[col_name].apply(lambda x: x.decode('utf-8') if isinstance(x, bytes) else str(x))
-    df[col_name] = df[col_name].str.strip()
+    df[col_name] = df[col_name].astype(ARROW_STRING_DTYPE).str.strip()
     return df
 
 
 def load_data():
-    """Load GNAF and transaction data."""
+    """Load GNAF data and open the transactions file as a dataset for filtered scans."""
     try:
-        gnaf_df = pd.read_parquet(GNAF_FILE)
+        gnaf_df = pd.read_parquet(
+            GNAF_FILE,
+            columns=[GNAF_PROP_ID_COL, GNAF_MESH_BLOCK_COL],
+            dtype_backend='pyarrow'
+        )
         gnaf_df = decode_binary_column(gnaf_df, GNAF_PROP_ID_COL)
         print(f"Loaded {len(gnaf_df)} properties from GNAF.")
 
-        trans_df = pd.read_parquet(TRANSACTIONS_FILE)
-        trans_df = decode_binary_column(trans_df, TRANS_PROP_ID_COL)
-        print(f"Loaded {len(trans_df)} transactions.")
+        # pyarrow's FileNotFoundError carries no filename, so check up front
+        if not os.path.exists(TRANSACTIONS_FILE):
+            print(f"File not found: {TRANSACTIONS_FILE}")
+            sys.exit(1)
+        trans_dataset = ds.dataset(TRANSACTIONS_FILE, format='parquet')
 
-        return gnaf_df, trans_df
+        return gnaf_df, trans_dataset
 
     except FileNotFoundError as e:
         print(f"File not found: {e.filename}")
@@ -54,54 +75,263 @@ def load_data():
         sys.exit(1)
 
 
-def process_transactions(gnaf_df, trans_df):
-    """Merge transactions with property data and clean."""
+def build_mesh_block_lookup(gnaf_df):
+    """Map each GNAF property ID to its Mesh Block."""
     cols_to_keep = [GNAF_PROP_ID_COL, GNAF_MESH_BLOCK_COL]
 
     if GNAF_MESH_BLOCK_COL not in gnaf_df.columns:
         print(f"Error: Column '{GNAF_MESH_BLOCK_COL}' not found in GNAF data.")
         sys.exit(1)
 
-    trans_df[TRANS_PROP_ID_COL] = trans_df[TRANS_PROP_ID_COL].astype(str)
-    gnaf_df[GNAF_PROP_ID_COL] = gnaf_df[GNAF_PROP_ID_COL].astype(str)
-    gnaf_df = gnaf_df.drop_duplicates(subset=[GNAF_PROP_ID_COL])
+    # Project and dedupe in a single gather so only the two join columns are copied
+    gnaf_lookup = gnaf_df.loc[~gnaf_df[GNAF_PROP_ID_COL].duplicated(), cols_to_keep]
+    mesh_block_by_id = gnaf_lookup.set_index(GNAF_PROP_ID_COL)[GNAF_MESH_BLOCK_COL]
+
+    # One categorical dtype for every year, so grouping hashes integer codes and
+    # the per-year results concatenate without re-encoding
+    return mesh_block_by_id.astype('category')
+
+
+def row_group_year_ranges(trans_dataset):
+    """(first, last) sale year of each row group from the date column's Parquet statistics, or None if unavailable."""
+    year_ranges = []
+    for fragment in trans_dataset.get_fragments():
+        if not isinstance(fragment, ds.ParquetFileFragment):
+            return None
+        for row_group in fragment.row_groups:
+            stats = row_group.statistics.get(TRANS_DATE_COL)
+            if not stats or 'min' not in stats or 'max' not in stats:
+                return None
+
+            bounds = pd.to_datetime(pd.Series([stats['min'], stats['max']]), format=TRANS_DATE_FORMAT, errors='coerce')
+            if bounds.isna().any():
+                return None
+            year_ranges.append((bounds[0].year, bounds[1].year))
+
+    return year_ranges
+
 
-    merged_data = trans_df.merge(
-        gnaf_df[cols_to_keep],
-        on=TRANS_PROP_ID_COL,
-        how='inner'
+def streaming_years(trans_dataset):
+    """Sale years to stream one at a time, or None when the date statistics cannot prune row groups."""
+    year_ranges = row_group_year_ranges(trans_dataset)
+    if not year_ranges or len(year_ranges) < 2:
+        return None
+
+    # A per-year scan still decodes every row group whose date range overlaps that year
+    row_group_reads = sum(last - first + 1 for first, last in year_ranges)
+    if row_group_reads > MAX_STREAMING_READS_PER_ROW_GROUP * len(year_ranges):
+        return None
+
+    return sorted({year for first, last in year_ranges for year in range(first, last + 1)})
+
+
+def load_transactions(trans_dataset, year=None):
+    """Load transactions, optionally for one sale year, with the filters pushed down to the scanner."""
+    scan_filter = ds.field(TRANS_PRICE_COL) > MINIMUM_SALE_PRICE
+    if year is not None:
+        # Dates are stored as strings in TRANS_DATE_FORMAT, which sorts in date order
+        year_start = pd.Timestamp(year=year, month=1, day=1).strftime(TRANS_DATE_FORMAT)
+        next_year_start = pd.Timestamp(year=year + 1, month=1, day=1).strftime(TRANS_DATE_FORMAT)
+        scan_filter &= (ds.field(TRANS_DATE_COL) >= year_start) & (ds.field(TRANS_DATE_COL) < next_year_start)
+
+    table = trans_dataset.to_table(
+        columns=[TRANS_PROP_ID_COL, TRANS_PRICE_COL, TRANS_DATE_COL],
+        filter=scan_filter
     )
+    trans_df = table.to_pandas(types_mapper=pd.ArrowDtype)
+    return decode_binary_column(trans_df, TRANS_PROP_ID_COL)
+
+
+def process_transactions(mesh_block_by_id, trans_df):
+    """Attach Mesh Blocks to transactions and clean."""
+    # A one-column lookup per key: map probes the ID index, whose hash table is built
+    # once and reused by every batch, and unmatched IDs come back as NA
+    mesh_blocks = trans_df[TRANS_PROP_ID_COL].map(mesh_block_by_id)
 
-    print(f"Successfully merged {len(merged_data)} transactions.")
-    if len(merged_data) == 0:
+    # float32 holds whole-dollar prices exactly up to ~$16.7M and halves the bytes fed to the median kernel
+    prices = pd.to_numeric(trans_df[TRANS_PRICE_COL], errors='coerce').to_numpy(dtype=np.float32, na_value=np.nan)
+    sale_dates = pd.to_datetime(trans_df[TRANS_DATE_COL], format=TRANS_DATE_FORMAT, errors='coerce')
+
+    # One boolean mask and one gather per column instead of a new frame per dropna/filter step.
+    # NaN prices compare False, so the price threshold also drops missing prices.
+    valid = mesh_blocks.notna().to_numpy() & sale_dates.notna().to_numpy() & (prices > MINIMUM_SALE_PRICE)
+
+    # Only the sale year is used downstream, so keep it as int16 rather than the full timestamp
+    merged_data = pd.DataFrame({
+        TRANS_PROP_ID_COL: trans_df[TRANS_PROP_ID_COL][valid],
+        TRANS_PRICE_COL: prices[valid],
+        GNAF_MESH_BLOCK_COL: mesh_blocks[valid],
+        'year': sale_dates[valid].dt.year.astype('int16'),
+    })
+
+    return merged_data
+
+
+@njit(parallel=True, cache=True)
+def median_count_by_group(prices, starts, ends, min_count):
+    """Median and count for each contiguous run of prices; runs below min_count get a NaN median."""
+    n_groups = len(starts)
+    medians = np.full(n_groups, np.nan)
+    counts = np.empty(n_groups, dtype=np.int64)
+    for g in prange(n_groups):
+        n = ends[g] - starts[g]
+        counts[g] = n
+        if n >= min_count:
+            # A single O(n) partition finds the middle instead of sorting the whole group.
+            # Upcast the group's slice so averaging the two middle prices cannot lose float32 precision.
+            values = np.partition(prices[starts[g]:ends[g]].astype(np.float64), n // 2)
+            upper_mid = values[n // 2]
+            if n % 2 == 1:
+                medians[g] = upper_mid
+            else:
+                # Everything left of the partition point is <= upper_mid, so its max is the lower middle
+                medians[g] = (values[:n // 2].max() + upper_mid) / 2.0
+    return medians, counts
+
+
+def group_runs(*keys):
+    """Start and end offsets of each run of equal keys in arrays that are already sorted by those keys."""
+    n_rows = len(keys[0])
+    is_group_start = np.zeros(n_rows, dtype=bool)
+    is_group_start[:1] = True
+    for key in keys:
+        is_group_start[1:] |= key[1:] != key[:-1]
+    starts = np.flatnonzero(is_group_start)
+    ends = np.append(starts[1:], n_rows)[:len(starts)]
+    return starts, ends
+
+
+def aggregate_medians(merged_data):
+    """Calculate median price and sales count by Mesh Block and year, filtering low-volume areas."""
+    sorted_data = merged_data.sort_values(by=[GNAF_MESH_BLOCK_COL, 'year'])
+    mb_col = sorted_data[GNAF_MESH_BLOCK_COL]
+    mb_codes = mb_col.cat.codes.to_numpy()
+    years = sorted_data['year'].to_numpy()
+    prices = sorted_data[TRANS_PRICE_COL].to_numpy(dtype=np.float32)
+
+    # Each (Mesh Block, year) group is a contiguous run of the sorted rows
+    starts, ends = group_runs(mb_codes, years)
+
+    medians, counts = median_count_by_group(prices, starts, ends, MINIMUM_SALES_COUNT)
+    keep = counts >= MINIMUM_SALES_COUNT
+
+    group_metrics = pd.DataFrame({
+        GNAF_MESH_BLOCK_COL: pd.Categorical.from_codes(mb_codes[starts[keep]], dtype=mb_col.dtype),
+        'year': years[starts[keep]],
+        'median': medians[keep],
+        'count': counts[keep],
+    })
+
+    return group_metrics, len(counts) - keep.sum()
+
+
+def aggregate_by_year(trans_dataset, mesh_block_by_id):
+    """Aggregate Mesh Block medians, streaming one sale year at a time when the date statistics allow it."""
+    years = streaming_years(trans_dataset)
+    if years is None:
+        # Every year would overlap most row groups, so one scan is far cheaper than one per year
+        batches = [load_transactions(trans_dataset)]
+    else:
+        print(f"Streaming transactions over {len(years)} sale years.")
+        batches = (load_transactions(trans_dataset, year) for year in years)
+
+    yearly_metrics = []
+    loaded_count = merged_count = removed_count = 0
+
+    for trans_df in batches:
+        merged_data = process_transactions(mesh_block_by_id, trans_df)
+        loaded_count += len(trans_df)
+        merged_count += len(merged_data)
+
+        if not merged_data.empty:
+            group_metrics, removed = aggregate_medians(merged_data)
+            yearly_metrics.append(group_metrics)
+            removed_count += removed
+
+    print(f"Loaded {loaded_count} transactions.")
+    print(f"Successfully merged {merged_count} transactions.")
+    if merged_count == 0:
         print("Merge resulted in 0 transactions.")
         sys.exit(1)
+    print(f"Removed {removed_count} low-volume rows.")
+
+    return pd.concat(yearly_metrics, ignore_index=True)
+
+
+def group_metrics_cache_path():
+    """Cache file for the per-year group metrics, keyed by input file mtimes and the settings that shape them."""
+    cache_key = repr((
+        [os.path.getmtime(path) if os.path.exists(path) else None for path in (GNAF_FILE, TRANSACTIONS_FILE)],
+        GNAF_MESH_BLOCK_COL, TRANS_DATE_FORMAT, MINIMUM_SALE_PRICE, MINIMUM_SALES_COUNT
+    ))
+    digest = hashlib.sha1(cache_key.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, f"group_metrics.{digest}.parquet")
+
+
+def load_group_metrics():
+    """Return per-year Mesh Block medians, reusing the cached result while the inputs are unchanged."""
+    cache_file = group_metrics_cache_path()
+    if os.path.exists(cache_file):
+        try:
+            group_metrics = pd.read_parquet(cache_file)
+        except (OSError, pa.ArrowException) as e:
+            # An unreadable cache is treated as a miss and recomputed
+            print(f"Ignoring unreadable cache file {cache_file}: {e}")
+            os.remove(cache_file)
+        else:
+            # Parquet does not round-trip the categorical dtype, so restore it for the growth pass
+            group_metrics[GNAF_MESH_BLOCK_COL] = group_metrics[GNAF_MESH_BLOCK_COL].astype('category')
+            print(f"Loaded cached group metrics from: {cache_file}")
+            return group_metrics
 
-    merged_data[TRANS_PRICE_COL] = pd.to_numeric(merged_data[TRANS_PRICE_COL], errors='coerce')
-    merged_data[TRANS_DATE_COL] = pd.to_datetime(merged_data[TRANS_DATE_COL], errors='coerce')
-    merged_data = merged_data.dropna(subset=[TRANS_PRICE_COL, TRANS_DATE_COL, GNAF_MESH_BLOCK_COL])
-    merged_data = merged_data[merged_data[TRANS_PRICE_COL] > 10000]
-    merged_data['year'] = merged_data[TRANS_DATE_COL].dt.year
+    gnaf_df, trans_dataset = load_data()
+    mesh_block_by_id = build_mesh_block_lookup(gnaf_df)
+    group_metrics = aggregate_by_year(trans_dataset, mesh_block_by_id)
 
-    return merged_data
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    for stale_file in glob.glob(os.path.join(CACHE_DIR, "group_metrics.*")):
+        os.remove(stale_file)
+
+    # Write alongside and swap in place so an interrupted write never leaves a truncated file under a valid key
+    tmp_file = f"{cache_file}.tmp"
+    group_metrics.to_parquet(tmp_file, compression='zstd', index=False)
+    os.replace(tmp_file, cache_file)
+
+    return group_metrics
 
 
-def aggregate_growth(merged_data):
-    """Calculate median price and YoY growth by Mesh Block, filtering low-volume areas."""
-    grouped = merged_data.groupby([GNAF_MESH_BLOCK_COL, 'year'])[TRANS_PRICE_COL]
-    metrics_with_count = grouped.agg(['median', 'count']).reset_index()
+@njit(parallel=True, cache=True)
+def yoy_growth_by_group(medians, starts, ends):
+    """Percentage change between consecutive medians within each contiguous run; each run starts at NaN."""
+    growth = np.empty(len(medians))
+    for g in prange(len(starts)):
+        growth[starts[g]] = np.nan
+        for i in range(starts[g] + 1, ends[g]):
+            growth[i] = (medians[i] / medians[i - 1] - 1.0) * 100.0
+    return growth
 
-    filtered_metrics = metrics_with_count[metrics_with_count['count'] >= MINIMUM_SALES_COUNT].copy()
-    print(f"Removed {len(metrics_with_count) - len(filtered_metrics)} low-volume rows.")
 
-    filtered_metrics = filtered_metrics.sort_values(by=[GNAF_MESH_BLOCK_COL, 'year'])
-    filtered_metrics['median_price_growth_yoy'] = filtered_metrics.groupby(GNAF_MESH_BLOCK_COL)['median'].pct_change() * 100
+def aggregate_growth(group_metrics):
+    """Calculate YoY growth of the median price by Mesh Block."""
+    mb_col = group_metrics[GNAF_MESH_BLOCK_COL]
+    # Order by (Mesh Block, year) with an index array and gather each column once, instead of sorting the frame
+    mb_codes = mb_col.cat.codes.to_numpy()
+    order = np.lexsort((group_metrics['year'].to_numpy(), mb_codes))
+    mb_codes = mb_codes[order]
+    medians = group_metrics['median'].to_numpy(dtype=np.float64)[order]
 
-    filtered_metrics = filtered_metrics.rename(columns={'median': 'median_price', 'count': 'sales_count'})
-    filtered_metrics['median_price'] = filtered_metrics['median_price'].round(0)
-    filtered_metrics['median_price_growth_yoy'] = filtered_metrics['median_price_growth_yoy'].round(2)
+    # Rows are ordered by (Mesh Block, year), so each Mesh Block's history is a contiguous run
+    starts, ends = group_runs(mb_codes)
 
-    return filtered_metrics
+    growth = yoy_growth_by_group(medians, starts, ends)
+
+    return pd.DataFrame({
+        GNAF_MESH_BLOCK_COL: pd.Categorical.from_codes(mb_codes, dtype=mb_col.dtype),
+        'year': group_metrics['year'].to_numpy()[order],
+        'median_price': medians.round(0),
+        'sales_count': group_metrics['count'].to_numpy()[order],
+        'median_price_growth_yoy': growth.round(2),
+    })
 
 
 def create_visualizations(metrics_df):
@@ -119,8 +349,21 @@ def create_visualizations(metrics_df):
         ]
 
         if not recent_growth.empty:
-            avg_growth = recent_growth.groupby('mb_2016_code')['median_price_growth_yoy'].mean()
-            top_10 = avg_growth.nlargest(10).sort_values(ascending=True)
+            # Average growth per Mesh Block from two bincount passes over the category codes
+            mb_col = recent_growth['mb_2016_code'].astype('category')
+            mb_codes = mb_col.cat.codes.to_numpy()
+            growth_values = recent_growth['median_price_growth_yoy'].to_numpy(dtype=np.float64)
+            n_mesh_blocks = len(mb_col.cat.categories)
+            growth_sums = np.bincount(mb_codes, weights=growth_values, minlength=n_mesh_blocks)
+            growth_counts = np.bincount(mb_codes, minlength=n_mesh_blocks)
+            observed = np.flatnonzero(growth_counts)
+            avg_growth = growth_sums[observed] / growth_counts[observed]
+
+            # Largest average first; equal averages keep the lowest Mesh Block first, as nlargest did
+            top_positions = np.lexsort((observed, -avg_growth))[:10]
+            top_ids = mb_col.cat.categories[observed[top_positions]]
+
+            top_10 = pd.Series(avg_growth[top_positions], index=top_ids).sort_values(ascending=True)
 
             top_10.index = top_10.index.astype(str)
 
@@ -141,25 +384,22 @@ def create_visualizations(metrics_df):
             top_10 = pd.Series()
 
         if not top_10.empty:
-            top_3_ids_original = avg_growth.nlargest(3).index
+            top_3_ids_original = top_ids[:3]
 
             top_3_history = metrics_df[metrics_df['mb_2016_code'].isin(top_3_ids_original)]
 
             if not top_3_history.empty:
-                price_history = top_3_history.pivot(
-                    index='year',
-                    columns='mb_2016_code',
-                    values='median_price'
-                )
-
                 fig, ax = plt.subplots(figsize=(12, 7))
                 
-                # Loop through each column (mb_2016_code) in the pivoted data
-                for mb_code in price_history.columns:
-                    # Plot each one as a separate line using ax.plot()
+                # Plot each Mesh Block straight from its own rows rather than pivoting to a year x Mesh Block grid.
+                # Reindexing on the shared years leaves NaN at missing years, so lines break there.
+                history_years = np.unique(top_3_history['year'])
+                for mb_code in top_3_history['mb_2016_code'].unique():
+                    mb_history = top_3_history[top_3_history['mb_2016_code'] == mb_code]
+                    mb_prices = mb_history.set_index('year')['median_price'].reindex(history_years)
                     ax.plot(
-                        price_history.index, 
-                        price_history[mb_code], 
+                        history_years, 
+                        mb_prices.to_numpy(), 
                         marker='o', 
                         linestyle='--', 
                         label=str(mb_code) # Ensure label is a string
@@ -192,12 +432,16 @@ if __name__ == "__main__":
 
     os.makedirs(RESULTS_DIR, exist_ok=True)
 
-    gnaf_df, trans_df = load_data()
-    processed_data = process_transactions(gnaf_df, trans_df)
-    final_metrics = aggregate_growth(processed_data)
+    group_metrics = load_group_metrics()
+    final_metrics = aggregate_growth(group_metrics)
 
     output_filename = os.path.join(RESULTS_DIR, "median_price_growth_by_mesh_block.csv")
-    final_metrics.to_csv(output_filename, index=False)
+    # pyarrow's native CSV writer formats columns in C rather than per row in Python
+    pa_csv.write_csv(
+        pa.Table.from_pandas(final_metrics, preserve_index=False),
+        output_filename,
+        write_options=pa_csv.WriteOptions(quoting_header='none')
+    )
 
     print("\nAnalysis Complete!")
     print(f"Saved metrics to: {output_filename}")
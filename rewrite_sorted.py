@@ -0,0 +1,43 @@
+import os
+import sys
+import pyarrow.parquet as pq
+
+from analysis import GNAF_FILE, TRANSACTIONS_FILE, GNAF_PROP_ID_COL, TRANS_DATE_COL
+
+# --- Configuration ---
+# Small enough that a row group of date-sorted transactions spans only a year or two
+ROW_GROUP_SIZE = 250_000
+COMPRESSION = 'zstd'
+
+
+def rewrite_sorted(path, sort_col):
+    """Rewrite a Parquet file sorted by sort_col so each row group covers a narrow key range."""
+    table = pq.read_table(path)
+    if sort_col not in table.column_names:
+        print(f"Error: Column '{sort_col}' not found in {path}.")
+        sys.exit(1)
+
+    table = table.sort_by(sort_col)
+
+    # Write alongside the original and swap in place so a failed write never leaves a truncated file
+    tmp_path = f"{path}.tmp"
+    pq.write_table(
+        table,
+        tmp_path,
+        row_group_size=ROW_GROUP_SIZE,
+        use_dictionary=True,
+        compression=COMPRESSION,
+        write_statistics=True
+    )
+    os.replace(tmp_path, path)
+    print(f"Rewrote {path}: {table.num_rows} rows sorted by {sort_col}.")
+
+
+if __name__ == "__main__":
+
+    # Transactions are sorted by sale date so analysis.py's per-year scans can skip row groups
+    for path, sort_col in [(GNAF_FILE, GNAF_PROP_ID_COL), (TRANSACTIONS_FILE, TRANS_DATE_COL)]:
+        if not os.path.exists(path):
+            print(f"File not found: {path}")
+            sys.exit(1)
+        rewrite_sorted(path, sort_col)